@@ -0,0 +1,11 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from server.modelhandler import ModelHandler
+from src.inference import TTSInference
+
+# app和webui共用的实例，只在这里创建一次，模型只占一份显存
+GPT_HANDLER = ModelHandler('pretrained_models/gpt_weights/')
+SOVITS_HANDLER = ModelHandler('pretrained_models/sovits_weights/')
+TTS = TTSInference()  # 精度由环境变量 TTS_PRECISION 决定
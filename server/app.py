@@ -1,39 +1,67 @@
+import asyncio
+import io
 import os
-import shutil
+import queue
 import sys
-from typing import Any, Optional
+from typing import Iterable, Optional, Tuple
+from urllib.parse import quote
 import zipfile
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-import chardet
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, APIRouter
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from server.excel_utils import read_excel_rows
+
+# Excel解析等纯Python的CPU密集工作放到子进程，不占用驱动GPU的事件循环和GIL。
+# 用fork启动：spawn会在每个子进程里重新执行 server/app.py，重新加载一遍模型。
+# 子进程默认在第一次提交任务时才fork，那时模型已经在显存上、线程池和事件循环也已经运行，
+# 所以在导入其他模块（加载模型）之前立即提交一个空任务，把子进程全部fork出来；
+# 子进程里只有这之前导入的模块，任务函数都要放在 server/excel_utils.py 这样没有副作用的模块里
+PROCESS_POOL = ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context("fork"))
+PROCESS_POOL.submit(int).result()
+
+from fastapi import FastAPI, Form, UploadFile, HTTPException, APIRouter, Depends, Request
 from contextlib import asynccontextmanager
-from pydantic import BaseModel, model_validator
-import json
-import tempfile
+import msgspec
+import orjson
 import soundfile as sf
 import logging
-from logging.handlers import RotatingFileHandler
-from starlette.responses import FileResponse
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from starlette.responses import StreamingResponse
 import gradio as gr
 import uvicorn
-import pandas as pd
 
 from server.asr import audio_line_check
 from server.webui import webui, LANG_DICT
-from server.modelhandler import ModelHandler
-from src.inference import TTSInference
+from server.modelhandler import cached_set_model, model_lock, INFER_POOL, CPU_POOL
+from server._singletons import TTS
+from server.batcher import TTSBatcher
+from server.audio_utils import wav_header, pcm_bytes, WAV_SUBTYPE, WAV_BITS
 
 root_logger = logging.getLogger()
 
-gpt_model_handler = ModelHandler('pretrained_models/gpt_weights/')
-sovits_model_handler = ModelHandler('pretrained_models/sovits_weights/')
-tts_inference = TTSInference(is_half=False)
-with open('server/example.json', 'r') as f:
-    example_json = json.load(f)
+tts_batcher = TTSBatcher(TTS)
+
+
+# 预设角色配置
+@dataclass(slots=True, frozen=True)
+class CharacterConfig:
+    audio_path: str
+    ref_text: str
+    ref_language: str
+    gpt_weights: str
+    sovits_weights: str
+
+
+# 启动时读取一次预设角色
+CHARACTERS = {name: CharacterConfig(**value)
+              for name, value in orjson.loads(Path('server/example.json').read_bytes()).items()}
 
 # 模型请求参数数据模型
-class TTSModelRequest(BaseModel):
+class TTSModelRequest(msgspec.Struct, kw_only=True, omit_defaults=True):
     character_name: Optional[str] = None
     ref_audio_path: Optional[str] = None
     sovits_weights: Optional[str] = None
@@ -48,39 +76,111 @@ class TTSModelRequest(BaseModel):
     temperature: Optional[float] = 0.7
     ref_free: Optional[bool] = False
     zip_filename: Optional[str] = None
-    
-    @model_validator(mode='before')
-    @classmethod
-    def validate_to_json(cls, value: Any) -> Any:
-        print(value)
-        if isinstance(value, str):
-            return cls(**json.loads(value))
-        return value
-    
-    
-async def remove_temp_file(path: str):
-    if os.path.isdir(path):
-        shutil.rmtree(path)
-    else:
-        os.remove(path)
+    chunk_size: Optional[int] = None  # batch推理每次一起合成的行数，不指定时按空闲显存自动选择
+
+
+# strict=False：和原来的pydantic模型一样接受 "5"、"0.7" 这样写成字符串的数字和布尔值
+tts_request_decoder = msgspec.json.Decoder(TTSModelRequest, strict=False)
+
+
+def decode_tts_request(content) -> TTSModelRequest:
+    """JSON解码并校验请求参数，格式不对时返回422"""
+    try:
+        return tts_request_decoder.decode(content)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def tts_request_body(request: Request) -> TTSModelRequest:
+    """请求体（JSON）解析为TTSModelRequest"""
+    return decode_tts_request(await request.body())
+
+
+def tts_request_form(data: str = Form(...)) -> TTSModelRequest:
+    """multipart表单中data字段（JSON字符串）解析为TTSModelRequest"""
+    return decode_tts_request(data)
+
+
+def wav_bytes(audio, sr: int) -> bytes:
+    """在内存中把音频编码为 WAV_SUBTYPE 格式的WAV文件"""
+    buf = io.BytesIO()
+    sf.write(buf, audio, sr, subtype=WAV_SUBTYPE, format='WAV')
+    return buf.getvalue()
+
+
+class _ZipSink(io.RawIOBase):
+    """只追加、不可seek的写入目标，ZipFile写入的字节暂存在这里，由zip_stream取走发送"""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def writable(self):
+        return True
 
-def setup_logging():
+    def write(self, b):
+        self.buffer += b
+        self.offset += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.offset
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def zip_stream(entries: Iterable[Tuple[str, bytes]]):
+    """边打包边产出zip字节流。WAV的PCM数据基本无法压缩，直接用ZIP_STORED存储"""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for name, content in entries:
+            zipf.writestr(name, content)
+            yield sink.take()
+    yield sink.take()
+
+
+def decode_zip_filename(member: zipfile.ZipInfo) -> str:
+    """
+    zip内文件名解码。设置了UTF-8标志位（bit 11）的zipfile已经正确解码；
+    否则zipfile按cp437解码，中文zip基本只有UTF-8和GBK两种，依次尝试即可。
+    """
+    if member.flag_bits & 0x800:
+        return member.filename
+    raw = member.filename.encode('cp437')
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('gbk', errors='replace')
+
+
+def setup_logging() -> QueueListener:
     #设置根日志记录器
     root_logger.setLevel(logging.INFO)
 
     rotating_handler = RotatingFileHandler('app.log')
     rotating_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    root_logger.addHandler(rotating_handler)
 
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    root_logger.addHandler(stream_handler)
+
+    # 请求处理中只把日志放进队列，写文件和输出到终端由后台线程完成
+    log_queue = queue.Queue(-1)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, rotating_handler, stream_handler)
+    listener.start()
+    return listener
         
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 设置日志
-    setup_logging()
+    log_listener = setup_logging()
+    # 启动动态batch后台任务
+    tts_batcher.start()
     yield
+    await tts_batcher.stop()
+    log_listener.stop()
     
 app = FastAPI(lifespan=lifespan)
 router = APIRouter()
@@ -98,127 +198,156 @@ async def exception_handler(request, exc):
 @router.post("/api/tts/inference")
 async def predict(
     #   audio_file: UploadFile, 
-    data: TTSModelRequest, 
-    background_tasks: BackgroundTasks
+    data: TTSModelRequest = Depends(tts_request_body)
 ):
     try:
         if data.character_name is not None:
-            data.ref_audio_path = example_json[data.character_name]['audio_path']
-            data.prompt_text = example_json[data.character_name]['ref_text']
-            data.prompt_language = example_json[data.character_name]['ref_language']
-            data.gpt_weights = example_json[data.character_name]['gpt_weights']
-            data.sovits_weights = example_json[data.character_name]['sovits_weights']
-        if tts_inference.sovits_model != data.sovits_weights:
-            tts_inference.change_sovits_weights(data.sovits_weights) # type: ignore
-        if tts_inference.gpt_model!= data.gpt_weights:
-            tts_inference.change_gpt_weights(data.gpt_weights) # type: ignore
-        # 进行预测
+            cfg = CHARACTERS[data.character_name]
+            data.ref_audio_path = cfg.audio_path
+            data.prompt_text = cfg.ref_text
+            data.prompt_language = cfg.ref_language
+            data.gpt_weights = cfg.gpt_weights
+            data.sovits_weights = cfg.sovits_weights
+        # 进行预测，请求进入共享的pool，和其他请求在各个模块中一起batch处理
         try:
-            print('generating......', flush=True)
-            audio_generator = tts_inference.infer(
-                data.ref_audio_path, # type: ignore
-                data.prompt_text,
-                LANG_DICT[data.prompt_language], # type: ignore
-                data.text,
-                LANG_DICT[data.text_language], # type: ignore
-                how_to_cut=data.how_to_cut, # type: ignore
-                top_k=data.top_k, # type: ignore
-                top_p=data.top_p, # type: ignore
-                temperature=data.temperature, # type: ignore
-                ref_free=data.ref_free) # type: ignore
-            
-            sr, audio = next(audio_generator)
-            print('generation finished!', flush=True)
+            root_logger.info('generating......')
+            audio_stream = tts_batcher.stream({
+                'sovits_weights': data.sovits_weights,
+                'gpt_weights': data.gpt_weights,
+                'ref_wav_path': data.ref_audio_path,
+                'prompt_text': data.prompt_text,
+                'prompt_language': LANG_DICT[data.prompt_language], # type: ignore
+                'text': data.text,
+                'text_language': LANG_DICT[data.text_language],
+                'how_to_cut': data.how_to_cut,
+                'top_k': data.top_k,
+                'top_p': data.top_p,
+                'temperature': data.temperature,
+                'ref_free': data.ref_free,
+            })
+            # 等到第一块音频再开始响应，前端处理等阶段的错误仍然可以返回500
+            first_chunk = await audio_stream.__anext__()
 
         except Exception as e:
             root_logger.error(f"Error during inference: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail="Error during inference")
         
-        # 创建一个临时文件来保存音频数据
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-        sf.write(temp_file.name, audio, sr, 'PCM_24')
-        
-        # 在后台删除临时文件
-        background_tasks.add_task(remove_temp_file, temp_file.name)
+        # 边合成边发送：先发长度未知的WAV头，再依次发送每块PCM数据
+        async def wav_stream():
+            try:
+                chunk = first_chunk
+                yield wav_header(chunk[0], bits_per_sample=WAV_BITS[WAV_SUBTYPE])
+                while chunk is not None:
+                    sr, audio = chunk
+                    yield pcm_bytes(audio)
+                    chunk = await anext(audio_stream, None)
+                root_logger.info('generation finished!')
+            finally:
+                # 客户端中途断开时关闭audio_stream，请求从batcher中移除，不再占用GPU解码
+                await audio_stream.aclose()
 
-        return FileResponse(temp_file.name, media_type='audio/wav')  # 发送文件
+        return StreamingResponse(wav_stream(), media_type='audio/wav')
 
     except KeyError as e:
         return {"error": f"Missing necessary parameter: {e.args[0]}"}, 400
 
 
+# batch推理时文本前端最多提前准备的组数
+PREPARE_AHEAD_GROUPS = 2
+
+
 @router.post("/api/tts/batch_inference")
 async def batch_predict(
-    data: TTSModelRequest,
-    excel_file: UploadFile, 
-    background_tasks: BackgroundTasks
+    excel_file: UploadFile,
+    data: TTSModelRequest = Depends(tts_request_form)
 ):
     try:
         # 读取上传的Excel文件
         contents = await excel_file.read()
-        df = pd.read_excel(contents, header=0)  # 假设第一行是表头
-        texts = df.iloc[:, 0].tolist()  # 跳过表头
-        filenames = df.iloc[:, 1].tolist()  # 跳过表头
+        loop = asyncio.get_running_loop()
+        try:
+            texts, filenames = await loop.run_in_executor(PROCESS_POOL, read_excel_rows, contents)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         if data.character_name is not None:
-            data.ref_audio_path = example_json[data.character_name]['audio_path']
-            data.prompt_text = example_json[data.character_name]['ref_text']
-            data.prompt_language = example_json[data.character_name]['ref_language']
-            data.gpt_weights = example_json[data.character_name]['gpt_weights']
-            data.sovits_weights = example_json[data.character_name]['sovits_weights']
-        if tts_inference.sovits_model != data.sovits_weights:
-            tts_inference.change_sovits_weights(data.sovits_weights) # type: ignore
-        if tts_inference.gpt_model!= data.gpt_weights:
-            tts_inference.change_gpt_weights(data.gpt_weights) # type: ignore
-        audio_files = []
-        for text, filename in zip(texts, filenames):
-            # 进行预测
+            cfg = CHARACTERS[data.character_name]
+            data.ref_audio_path = cfg.audio_path
+            data.prompt_text = cfg.ref_text
+            data.prompt_language = cfg.ref_language
+            data.gpt_weights = cfg.gpt_weights
+            data.sovits_weights = cfg.sovits_weights
+
+        # 同一个batch请求的公共参数，每行只有文本不同
+        base_request = {
+            'ref_wav_path': data.ref_audio_path,
+            'prompt_text': data.prompt_text,
+            'prompt_language': LANG_DICT[data.prompt_language], # type: ignore
+            'text_language': LANG_DICT[data.text_language],
+            'how_to_cut': data.how_to_cut,
+            'top_k': data.top_k,
+            'top_p': data.top_p,
+            'temperature': data.temperature,
+            'ref_free': data.ref_free,
+        }
+        chunk_size = max(1, data.chunk_size or TTS.auto_batch_size())
+
+        def prepare_text(text):
+            return TTS.prepare_text(base_request['prompt_text'], base_request['prompt_language'], text,
+                                    base_request['text_language'], base_request['how_to_cut'], base_request['ref_free'])
+
+        def submit_group(start):
+            return [loop.run_in_executor(CPU_POOL, prepare_text, text) for text in texts[start:start + chunk_size]]
+
+        # 文本前端在CPU线程池中只提前准备 PREPARE_AHEAD_GROUPS 组，和前面几组的GPU推理同时进行，
+        # 不一次把所有行都提交到线程池，占满其他请求要用的CPU_POOL
+        starts = range(0, len(texts), chunk_size)
+        text_futures = deque(submit_group(start) for start in starts[:PREPARE_AHEAD_GROUPS])
+        wav_futures = []
+        try:
+            # 持有model_lock期间其他请求不能切换模型；推理在INFER_POOL线程中进行，不阻塞事件循环
+            async with model_lock:
+                await loop.run_in_executor(INFER_POOL, cached_set_model, TTS, data.sovits_weights, data.gpt_weights)
+                # 每 chunk_size 行合成一个batch一起推理
+                for i, start in enumerate(starts):
+                    if i + PREPARE_AHEAD_GROUPS < len(starts):
+                        text_futures.append(submit_group(starts[i + PREPARE_AHEAD_GROUPS]))
+                    try:
+                        root_logger.info(f'generating {start}~{min(start + chunk_size, len(texts))} / {len(texts)}......')
+                        requests = [dict(base_request, text=text, prepared_text=await text_future)
+                                    for text, text_future in zip(texts[start:start + chunk_size], text_futures[0])]
+                        text_futures.popleft()
+                        results = await loop.run_in_executor(INFER_POOL, TTS.infer_batch, requests)
+                        root_logger.info('generation finished!')
+
+                    except Exception as e:
+                        root_logger.error(f"Error during inference: {str(e)}", exc_info=True)
+                        raise HTTPException(status_code=500, detail="Error during inference")
+                    # WAV编码在CPU线程池中进行，和下一组的GPU推理同时进行
+                    for filename, (sr, audio) in zip(filenames[start:start + chunk_size], results):
+                        wav_futures.append((filename, CPU_POOL.submit(wav_bytes, audio, sr)))
+        except BaseException:
+            # 出错或请求被取消时，还没开始的文本前端和WAV编码不再需要
+            for group in text_futures:
+                for text_future in group:
+                    text_future.cancel()
+            for _, wav_future in wav_futures:
+                wav_future.cancel()
+            raise
+
+        # 将所有音频打包成zip边编码边发送，不经过临时文件
+        def entries():
             try:
-                print('generating......', flush=True)
-                audio_generator = tts_inference.infer(
-                    data.ref_audio_path, # type: ignore
-                    data.prompt_text,
-                    LANG_DICT[data.prompt_language], # type: ignore
-                    text,
-                    LANG_DICT[data.text_language], # type: ignore
-                    how_to_cut=data.how_to_cut, # type: ignore
-                    top_k=data.top_k, # type: ignore
-                    top_p=data.top_p, # type: ignore
-                    temperature=data.temperature, # type: ignore
-                    ref_free=data.ref_free) # type: ignore
-                
-                sr, audio = next(audio_generator)
-                print('generation finished!', flush=True)
-
-            except Exception as e:
-                root_logger.error(f"Error during inference: {str(e)}", exc_info=True)
-                raise HTTPException(status_code=500, detail="Error during inference")
-            
-            # 创建一个临时文件来保存音频数据
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-            sf.write(temp_file.name, audio, sr, 'PCM_24')
-            
-            # 重命名临时文件为指定的文件名
-            final_path = os.path.join(tempfile.gettempdir(), filename)
-            os.rename(temp_file.name, final_path)
-            
-            audio_files.append(final_path)
-
-        # 将所有音频文件打包成一个zip文件
-        zip_file = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
-        with zipfile.ZipFile(zip_file.name, 'w') as zipf:
-            for audio_file in audio_files:
-                zipf.write(audio_file, os.path.basename(audio_file))
-        if data.zip_filename is not None:
-            final_zip_path = os.path.join(tempfile.gettempdir(), data.zip_filename)
-            os.rename(zip_file.name, final_zip_path)
-        
-        # 在后台删除音频文件和zip文件
-        for audio_file in audio_files:
-            background_tasks.add_task(remove_temp_file, audio_file)
-        background_tasks.add_task(remove_temp_file, final_zip_path)
+                for filename, wav_future in wav_futures:
+                    yield os.path.basename(filename), wav_future.result()
+            finally:
+                # 客户端中途断开时取消剩下的WAV编码
+                for _, wav_future in wav_futures:
+                    wav_future.cancel()
 
-        return FileResponse(final_zip_path, media_type='application/zip')  # 发送zip文件
+        zip_filename = data.zip_filename or 'audios.zip'
+        headers = {'Content-Disposition': f"attachment; filename*=UTF-8''{quote(zip_filename)}"}
+        return StreamingResponse(zip_stream(entries()), media_type='application/zip', headers=headers)  # 发送zip文件
 
     except KeyError as e:
         return {"error": f"Missing necessary parameter: {e.args[0]}"}, 400
@@ -239,10 +368,7 @@ async def batch_predict(
 #     # 解压zip文件
 #     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
 #         for member in zip_ref.infolist():
-#             encoding = chardet.detect(member.filename.encode('cp437'))['encoding']
-#             if encoding is None:
-#                 encoding = 'utf-8'  # 默认使用utf-8
-#             member.filename = member.filename.encode('cp437').decode(encoding)
+#             member.filename = decode_zip_filename(member)
 #             zip_ref.extract(member, temp_dir)
     
 #     # 假设解压后的文件夹结构是固定的
@@ -276,4 +402,5 @@ app.include_router(router, prefix="/ai-speech")
 
 if __name__ == '__main__':
     # 运行Uvicorn服务器
-    uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info")
\ No newline at end of file
+    # 单GPU、模型状态全局共享，只用一个进程；事件循环和HTTP解析用uvloop、httptools
+    uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info", loop="uvloop", http="httptools")
\ No newline at end of file
@@ -0,0 +1,31 @@
+import os
+import struct
+
+import numpy as np
+
+# 流式输出时长度未知，RIFF和data块的长度都填最大值
+UNKNOWN_SIZE = 0xFFFFFFFF
+# 输出WAV的采样格式，PCM_16（默认）或 PCM_24。合成结果本来就是int16，PCM_16不需要任何转换
+WAV_SUBTYPE = os.environ.get('TTS_WAV_SUBTYPE', 'PCM_16')
+WAV_BITS = {'PCM_16': 16, 'PCM_24': 24}
+if WAV_SUBTYPE not in WAV_BITS:
+    raise ValueError(f"不支持的TTS_WAV_SUBTYPE: {WAV_SUBTYPE}，可选 {list(WAV_BITS)}")
+
+
+def wav_header(sr: int, channels: int = 1, bits_per_sample: int = 24) -> bytes:
+    """生成长度未知的PCM WAV文件头，后面直接拼接PCM数据即可边合成边发送"""
+    block_align = channels * bits_per_sample // 8
+    return (
+        b'RIFF' + struct.pack('<I', UNKNOWN_SIZE) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sr, sr * block_align, block_align, bits_per_sample)
+        + b'data' + struct.pack('<I', UNKNOWN_SIZE)
+    )
+
+
+def pcm_bytes(audio: np.ndarray) -> bytes:
+    """按 WAV_SUBTYPE 把int16音频转为小端PCM字节（PCM_24与 sf.write(..., 'PCM_24') 的结果一致，低8位补0）"""
+    if WAV_SUBTYPE == 'PCM_16':
+        return audio.astype('<i2', copy=False).tobytes()
+    out = np.zeros((audio.shape[0], 3), dtype=np.uint8)
+    out[:, 1:] = audio.astype('<i2').view(np.uint8).reshape(-1, 2)
+    return out.tobytes()
@@ -0,0 +1,249 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from server.modelhandler import cached_set_model, model_lock, INFER_POOL, CPU_POOL
+from src.inference import TTSInference, MODULE_FRONTEND, MODULE_GPT, MODULE_SOVITS, MODULE_DONE, is_queued_segment
+
+# pool中同时处理的请求数上限
+MAX_BATCH = 8
+
+root_logger = logging.getLogger()
+
+
+def remove_item(items, target):
+    """按对象身份从列表中移除（pool项里有tensor，不能用list.remove的==比较）"""
+    items[:] = [item for item in items if item is not target]
+
+
+class TTSBatcher:
+    """
+    模块级动态batch。
+    所有请求共享一个pool，pool中每一项带有module_indicator（0 前端，1 GPT解码，2 SoVITS，3 完成）。
+    GPT任务每一轮运行前端和GPT解码一步，新请求可以在其他请求GPT解码的过程中随时加入；
+    GPT每生成一段semantic token就交给SoVITS任务合成，两者分别在自己的线程（以及CUDA stream）上同时运行。
+    请求提交时就在CPU线程池中开始文本前端（切句、g2p），和正在进行的GPU解码同时运行。
+    合成好的音频块按顺序放进请求自己的asyncio.Queue。
+    """
+    def __init__(self, tts_inference: TTSInference, max_batch=MAX_BATCH):
+        self.tts_inference = tts_inference
+        self.max_batch = max_batch
+        self.pending = deque()  # 等待进入pool的请求
+        self.active = []        # 已进入pool、还没有全部合成完的请求
+        self.pool = []
+        self.weights = None     # pool中请求使用的 (sovits_weights, gpt_weights)
+        self.wakeup = None
+        self.sovits_wakeup = None
+        self.tasks = []
+        self.lock_held = False  # pool中有请求时持有model_lock，其他地方不能切换模型
+        # 前端和GPT在共享的推理线程中运行，SoVITS单独一个线程（在自己的CUDA stream上）
+        self.gpt_executor = INFER_POOL
+        self.sovits_executor = ThreadPoolExecutor(max_workers=1)
+
+
+    def start(self):
+        """在事件循环中启动后台任务（lifespan中调用）"""
+        self.wakeup = asyncio.Event()
+        self.sovits_wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.run()), asyncio.create_task(self.run_sovits())]
+
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.tasks = []
+        self.release_if_idle(force=True)
+
+
+    async def submit(self, payload: dict):
+        """
+        提交一个推理请求，payload 包含 sovits_weights、gpt_weights 以及 infer 的全部参数。
+        返回请求：它的'queue'按顺序收到合成好的音频块 (sr, audio)，全部完成后收到None，出错时收到异常。
+        """
+        queue = asyncio.Queue()
+        request = dict(payload, module_indicator=MODULE_FRONTEND, queue=queue,
+                       segments=None, next_segment=0)
+        request['text_future'] = asyncio.get_running_loop().run_in_executor(
+            CPU_POOL, self.tts_inference.prepare_text,
+            payload['prompt_text'], payload['prompt_language'], payload['text'],
+            payload['text_language'], payload['how_to_cut'], payload.get('ref_free', False))
+        request['text_future'].add_done_callback(lambda _: self.wakeup.set())
+        self.pending.append(request)
+        self.wakeup.set()
+        return request
+
+
+    async def stream(self, payload: dict):
+        """
+        提交请求，按顺序异步产出合成好的音频块 (sr, audio)。
+        没有取完就被关闭或取消（客户端断开）时，请求从batcher中移除，不再占用解码位置。
+        """
+        request = await self.submit(payload)
+        finished = False
+        try:
+            while True:
+                chunk = await request['queue'].get()
+                if chunk is None:
+                    finished = True
+                    return
+                if isinstance(chunk, Exception):
+                    finished = True
+                    raise chunk
+                yield chunk
+        finally:
+            if not finished:
+                self.cancel(request)
+
+
+    async def admit(self):
+        """
+        把等待中的请求放进pool。pool中的请求必须使用同一组模型，
+        模型不同的请求要等pool中的请求全部完成后再切换模型。
+        pool从空变为非空时先拿到model_lock，和batch推理、webui的推理互斥；
+        有其他使用者在等锁时不再接收新请求，让pool尽快清空把锁让出去。
+        """
+        if self.pending and not self.active and not self.lock_held:
+            await model_lock.acquire()
+            self.lock_held = True
+        while self.pending and len(self.active) < self.max_batch:
+            if self.active and model_lock.drain_requested:
+                break
+            request = self.pending[0]
+            weights = (request['sovits_weights'], request['gpt_weights'])
+            if self.active and weights != self.weights:
+                break
+            self.pending.popleft()
+            self.weights = weights
+            self.active.append(request)
+            self.pool.append(request)
+
+
+    async def run(self):
+        """GPT任务：前端处理新请求，并让pool中所有正在解码的句子前进一个token"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pool and not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            await self.admit()
+
+            for request in [item for item in self.pool if self.frontend_ready(item)]:
+                remove_item(self.pool, request)
+                try:
+                    request['prepared_text'] = request['text_future'].result()
+                    items = await loop.run_in_executor(self.gpt_executor, self.frontend, request)
+                except Exception as e:
+                    root_logger.error(f"Error during inference: {str(e)}", exc_info=True)
+                    self.fail(request, e)
+                    continue
+                if not any(active is request for active in self.active):
+                    # 前端处理期间请求已经被取消
+                    continue
+                request['segments'] = items
+                self.pool.extend(items)
+            self.emit()
+
+            if not any(item['module_indicator'] == MODULE_GPT or is_queued_segment(item) for item in self.pool):
+                if self.pending and not self.active:
+                    # pool已经清空，可以切换模型接收等待中的请求
+                    continue
+                if any(self.frontend_ready(item) for item in self.pool):
+                    continue
+                # 剩下的都在等SoVITS，等它处理完（或有新请求）再继续，避免空转
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            try:
+                await loop.run_in_executor(self.gpt_executor, self.tts_inference.gpt_decode_step, list(self.pool))
+            except Exception as e:
+                self.fail_all(e)
+                continue
+            self.sovits_wakeup.set()
+
+
+    async def run_sovits(self):
+        """SoVITS任务：合成GPT交过来的semantic块，和GPT解码同时进行"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not any(item.get('chunks') or item['module_indicator'] == MODULE_SOVITS for item in self.pool):
+                self.sovits_wakeup.clear()
+                await self.sovits_wakeup.wait()
+                continue
+            try:
+                await loop.run_in_executor(self.sovits_executor, self.tts_inference.sovits_decode, list(self.pool))
+            except Exception as e:
+                self.fail_all(e)
+                continue
+            self.emit()
+            self.wakeup.set()
+
+
+    def frontend_ready(self, item):
+        """pool项是否是文本前端已经完成、可以做GPU前端处理的请求"""
+        return (item['module_indicator'] == MODULE_FRONTEND and not is_queued_segment(item)
+                and item['text_future'].done())
+
+
+    def frontend(self, request):
+        """在推理线程中运行：切换到请求对应的模型后做前端的GPU部分（bert特征、参考音频）"""
+        cached_set_model(self.tts_inference, request['sovits_weights'], request['gpt_weights'])
+        return self.tts_inference.run_frontend(request)
+
+
+    def emit(self):
+        """按句子和块的顺序把合成好的音频交给请求，请求的所有句子都完成后发送结束标记None"""
+        for request in list(self.active):
+            if request['segments'] is None:
+                continue
+            while request['next_segment'] < len(request['segments']):
+                item = request['segments'][request['next_segment']]
+                ###先看状态再取音频：SoVITS线程在标记完成之前已经放入了最后的音频块
+                done = item['module_indicator'] == MODULE_DONE
+                while item['audio_chunks']:
+                    request['queue'].put_nowait((item['sr'], item['audio_chunks'].popleft()))
+                if not done:
+                    break
+                remove_item(self.pool, item)
+                request['next_segment'] += 1
+            if request['next_segment'] == len(request['segments']):
+                request['queue'].put_nowait(None)
+                remove_item(self.active, request)
+        self.release_if_idle()
+
+
+    def fail(self, request, exc):
+        request['queue'].put_nowait(exc)
+        remove_item(self.active, request)
+        self.pool[:] = [item for item in self.pool if item is not request and item.get('request') is not request]
+        self.release_if_idle()
+
+
+    def cancel(self, request):
+        """放弃一个还没完成的请求：从等待队列、active和pool中移除它和它的所有句子"""
+        request['text_future'].cancel()
+        self.pending = deque(item for item in self.pending if item is not request)
+        remove_item(self.active, request)
+        self.pool[:] = [item for item in self.pool if item is not request and item.get('request') is not request]
+        self.release_if_idle()
+
+
+    def fail_all(self, exc):
+        root_logger.error(f"Error during inference: {str(exc)}", exc_info=exc)
+        for request in list(self.active):
+            self.fail(request, exc)
+        self.pool.clear()
+
+
+    def release_if_idle(self, force=False):
+        """pool中的请求都完成后释放model_lock，让等待中的其他推理可以切换模型"""
+        if self.lock_held and (force or not self.active):
+            model_lock.release()
+            self.lock_held = False
@@ -0,0 +1,34 @@
+import io
+import os
+from typing import Tuple
+
+import openpyxl
+
+
+def read_excel_rows(contents: bytes) -> Tuple[list, list]:
+    """
+    读取batch推理上传的Excel：第一列为文本，第二列为文件名，第一行是表头。
+    在 server/app.py 的 PROCESS_POOL 子进程中运行。
+    文件名为空或（去掉目录后）与前面的行重复时抛出ValueError，指明是哪一行。
+    """
+    # 只读模式逐行读取前两列（文本、文件名），不构建DataFrame
+    wb = openpyxl.load_workbook(io.BytesIO(contents), read_only=True, data_only=True)
+    try:
+        rows = list(wb.active.iter_rows(min_row=2, max_col=2, values_only=True))  # 跳过表头
+    finally:
+        wb.close()
+    texts, filenames, seen = [], [], {}
+    for row_number, (text, filename) in enumerate(rows, start=2):
+        if text is None:
+            continue
+        filename = '' if filename is None else str(filename).strip()
+        # zip里只用去掉目录后的文件名
+        name = os.path.basename(filename)
+        if not name:
+            raise ValueError(f"第{row_number}行的文件名为空")
+        if name in seen:
+            raise ValueError(f"第{row_number}行的文件名 {name} 与第{seen[name]}行重复")
+        seen[name] = row_number
+        texts.append(str(text))
+        filenames.append(filename)
+    return texts, filenames
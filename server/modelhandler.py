@@ -3,6 +3,60 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 切换模型会修改共享的推理实例，FastAPI和gradio可能在不同线程里同时调用
+switch_lock = threading.Lock()
+class ModelLock:
+    """
+    切换模型和推理互斥：持有这个锁期间其他请求不能切换模型，也不能用这个推理实例。
+    动态batch在pool非空时一直持有它；有其他使用者（batch推理、webui）在等待时drain_requested为True，
+    动态batch不再接收新请求，pool清空后让出锁。
+    """
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+
+    @property
+    def drain_requested(self) -> bool:
+        return self.waiters > 0
+
+    async def acquire(self):
+        self.waiters += 1
+        try:
+            await self.lock.acquire()
+        finally:
+            self.waiters -= 1
+
+    def release(self):
+        self.lock.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+model_lock = ModelLock()
+# 推理只在这一个线程里进行，模型状态只被一个线程访问
+INFER_POOL = ThreadPoolExecutor(max_workers=1)
+# 文本前端（切句、g2p）等纯CPU的工作，和GPU推理同时进行
+CPU_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def cached_set_model(tts_inference, sovits_weights=None, gpt_weights=None):
+    """
+    把推理实例切换到指定的模型，已经是这个模型时什么都不做。
+    最近用过的模型由推理实例缓存在内存中，切换回来时只需拷贝到显存。
+    """
+    with switch_lock:
+        if sovits_weights is not None and tts_inference.sovits_model_path != sovits_weights:
+            tts_inference.change_sovits_weights(sovits_weights)
+        if gpt_weights is not None and tts_inference.gpt_model_path != gpt_weights:
+            tts_inference.change_gpt_weights(gpt_weights)
 
 
 class ModelHandler:
@@ -1,17 +1,16 @@
 import os
 import sys
+import asyncio
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import gradio as gr
 import argparse
 from functools import partial
-from server.modelhandler import ModelHandler
+from server.modelhandler import ModelHandler, cached_set_model, model_lock, INFER_POOL
+from server._singletons import GPT_HANDLER, SOVITS_HANDLER, TTS
 from src.inference import TTSInference
 from src.utils.cut import CUT_DICT
 
 
-gpt_model_handler = ModelHandler('pretrained_models/gpt_weights/')
-sovits_model_handler = ModelHandler('pretrained_models/sovits_weights/')
-tts_inference = TTSInference(is_half=False)
 LANG_DICT = {
     "中文": 'all_zh',
     "英文": 'en',   
@@ -69,7 +68,7 @@ def select_model_func(speaker_name, handler):
                 )
 
 
-def get_tts_wav(sovits_speaker,
+async def get_tts_wav(sovits_speaker,
                 sovits_model,
                 gpt_speaker,
                 gpt_model,
@@ -82,27 +81,32 @@ def get_tts_wav(sovits_speaker,
                 top_k=5,
                 top_p=0.7,
                 temperature=0.7,
-                ref_free = False):
-    sovits_model = sovits_model_handler.models_info[sovits_speaker][sovits_model]
-    gpt_model = gpt_model_handler.models_info[gpt_speaker][gpt_model]
-    if tts_inference.sovits_model != sovits_model:
-        tts_inference.change_sovits_weights(sovits_model)
-    if tts_inference.gpt_model!= gpt_model:
-        tts_inference.change_gpt_weights(gpt_model)
-    
-    audio_generator = tts_inference.infer(
-        tts_ref_audio,
-        tts_prompt_text,
-        LANG_DICT[tts_prompt_language], # type: ignore
-        tts_text,
-        LANG_DICT[tts_text_language], # type: ignore
-        how_to_cut=how_to_cut,
-        top_k=top_k,
-        top_p=top_p,
-        temperature=temperature,
-        ref_free=ref_free)
-    
-    sr, audio = next(audio_generator)
+                ref_free = False,
+                *,
+                tts_inference: TTSInference,
+                gpt_handler: ModelHandler,
+                sovits_handler: ModelHandler):
+    sovits_model = sovits_handler.models_info[sovits_speaker][sovits_model]
+    gpt_model = gpt_handler.models_info[gpt_speaker][gpt_model]
+
+    def do_infer():
+        cached_set_model(tts_inference, sovits_model, gpt_model)
+        audio_generator = tts_inference.infer(
+            tts_ref_audio,
+            tts_prompt_text,
+            LANG_DICT[tts_prompt_language], # type: ignore
+            tts_text,
+            LANG_DICT[tts_text_language], # type: ignore
+            how_to_cut=how_to_cut,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            ref_free=ref_free)
+        return next(audio_generator)
+
+    # 切换模型和推理一起在锁内完成，推理线程中进行，避免和API请求互相切换模型
+    async with model_lock:
+        sr, audio = await asyncio.get_running_loop().run_in_executor(INFER_POOL, do_infer)
     return (sr, audio)
     
 
@@ -123,7 +127,7 @@ def webui():
             with gr.Row():
                 with gr.Column():
                     gpt_speakers_list = gr.Dropdown(
-                        choices = ['All speakers'] + list(gpt_model_handler.models_info.keys()),
+                        choices = ['All speakers'] + list(GPT_HANDLER.models_info.keys()),
                         label = 'gpt模型',
                         info = '选择说话人',
                         interactive = True
@@ -137,7 +141,7 @@ def webui():
                     )
                 with gr.Column():
                     sovits_speakers_list = gr.Dropdown(
-                        choices = ['All speakers'] + list(sovits_model_handler.models_info.keys()),
+                        choices = ['All speakers'] + list(SOVITS_HANDLER.models_info.keys()),
                         label = 'sovits模型',
                         info = '选择说话人',
                         interactive = True
@@ -151,18 +155,18 @@ def webui():
                     )
                 ## 刷新模型按钮
                 model_refresh_button = create_model_refresh_button(
-                    handlers=[gpt_model_handler, sovits_model_handler],
+                    handlers=[GPT_HANDLER, SOVITS_HANDLER],
                     refresh_components=[gpt_speakers_list, sovits_speakers_list], 
                     refresh_method="load_models_info", 
-                    refreshed_args=[lambda: {'choices': ['All speakers'] + list(gpt_model_handler.models_info.keys())},
-                                    lambda: {'choices': ['All speakers'] + list(sovits_model_handler.models_info.keys())}],
+                    refreshed_args=[lambda: {'choices': ['All speakers'] + list(GPT_HANDLER.models_info.keys())},
+                                    lambda: {'choices': ['All speakers'] + list(SOVITS_HANDLER.models_info.keys())}],
                     refresh_value="刷新模型"
                 )
                 ## 当选择角色后，弹出对应文件夹下的模型
-                gpt_speakers_list.change(partial(select_model_func, handler=gpt_model_handler), 
+                gpt_speakers_list.change(partial(select_model_func, handler=GPT_HANDLER), 
                                          inputs=[gpt_speakers_list], 
                                          outputs=gpt_model_list)
-                sovits_speakers_list.change(partial(select_model_func, handler=sovits_model_handler),
+                sovits_speakers_list.change(partial(select_model_func, handler=SOVITS_HANDLER),
                                             inputs=[sovits_speakers_list], 
                                             outputs=sovits_model_list)
             
@@ -257,7 +261,7 @@ def webui():
                     inference_button = gr.Button("开始合成", variant="primary")
                     tts_output_audio = gr.Audio(label="输出音频")
             inference_button.click(
-                get_tts_wav,
+                partial(get_tts_wav, tts_inference=TTS, gpt_handler=GPT_HANDLER, sovits_handler=SOVITS_HANDLER),
                 inputs = [sovits_speakers_list,
                           sovits_model_list,
                           gpt_speakers_list,
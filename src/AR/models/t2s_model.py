@@ -1,4 +1,6 @@
 # modified from https://github.com/feng-yufei/shared_debugging_code/blob/main/model/t2s_model.py
+import logging
+
 import torch
 from tqdm import tqdm
 
@@ -21,6 +23,8 @@ from torch import nn
 from torch.nn import functional as F
 from torchmetrics.classification import MulticlassAccuracy
 
+logger = logging.getLogger(__name__)
+
 default_config = {
     "embedding_dim": 512,
     "hidden_dim": 512,
@@ -389,7 +393,7 @@ class Text2SemanticDecoder(nn.Module):
         for idx in tqdm(range(1500)):
             
             xy_dec, _ = self.h((xy_pos, None), mask=xy_attn_mask, cache=cache)
-            logits = self.ar_predict_layer(
+            logits = self.predict_logits(
                 xy_dec[:, -1]
             )  ##不用改，如果用了cache的默认就是只有一帧，取最后一帧一样的
             # samples = topk_sampling(logits, top_k=top_k, top_p=1.0, temperature=temperature)
@@ -445,3 +449,233 @@ class Text2SemanticDecoder(nn.Module):
         if ref_free:
             return y[:, :-1], 0
         return y[:, :-1], idx-1
+
+    def predict_logits(self, xy_dec):
+        """
+        预测层在autocast之外计算，logits（采样和EOS判断）统一转成FP32。
+        预测层保持FP32时（precision低精度只转换transformer）按FP32计算；整个模型.half()时（is_half）按它自己的精度计算。
+        """
+        with torch.autocast(xy_dec.device.type, enabled=False):
+            return self.ar_predict_layer(xy_dec.to(self.ar_predict_layer.weight.dtype)).float()
+
+    def _expand_attn_mask(self, attn_mask):
+        """(B, L, S) -> (B * num_head, L, S)，与MHA内部的 bsz * num_heads 排布一致"""
+        bsz, tgt_len, src_len = attn_mask.shape
+        return (
+            attn_mask.unsqueeze(1)
+            .expand(-1, self.num_head, -1, -1)
+            .reshape(bsz * self.num_head, tgt_len, src_len)
+        )
+
+    def _prefill_batch(self, x_list, prompts_list, bert_list):
+        """
+        多条样本的首次前向。各样本左侧padding到同一长度，padding位置通过attn_mask屏蔽。
+        返回 (logits, cache, padding_mask)：cache中每层kv形状为 (S, B, E)，padding_mask为 (B, S)，True表示padding。
+        """
+        xy_pos_list = []
+        x_lens = []
+        for x, prompts, bert_feature in zip(x_list, prompts_list, bert_list):
+            x = self.ar_text_embedding(x.unsqueeze(0))
+            x = x + self.bert_proj(bert_feature.unsqueeze(0).transpose(1, 2))
+            x = self.ar_text_position(x)
+            if prompts is not None:
+                y_pos = self.ar_audio_position(self.ar_audio_embedding(prompts.unsqueeze(0)))
+                xy_pos_list.append(torch.concat([x, y_pos], dim=1)[0])
+            else:
+                xy_pos_list.append(x[0])
+            x_lens.append(x.shape[1])
+
+        bsz = len(xy_pos_list)
+        src_lens = [xy.shape[0] for xy in xy_pos_list]
+        max_len = max(src_lens)
+        device = xy_pos_list[0].device
+        xy_pos = torch.stack(
+            [F.pad(xy, (0, 0, max_len - xy.shape[0], 0)) for xy in xy_pos_list]
+        )
+        ###True为不可见。x只看x，y看全部x和之前的y；左侧padding行只看自己，避免整行被屏蔽softmax出nan
+        xy_attn_mask = torch.ones((bsz, max_len, max_len), dtype=torch.bool, device=device)
+        padding_mask = torch.ones((bsz, max_len), dtype=torch.bool, device=device)
+        for i, (src_len, x_len) in enumerate(zip(src_lens, x_lens)):
+            pad = max_len - src_len
+            y_len = src_len - x_len
+            xy_attn_mask[i, pad:, pad:pad + x_len] = False
+            xy_attn_mask[i, pad + x_len:, pad + x_len:] = torch.triu(
+                torch.ones(y_len, y_len, dtype=torch.bool, device=device), diagonal=1
+            )
+            pad_idx = torch.arange(pad, device=device)
+            xy_attn_mask[i, pad_idx, pad_idx] = False
+            padding_mask[i, pad:] = False
+
+        cache = {
+            "all_stage": self.num_layers,
+            "k": [None] * self.num_layers,
+            "v": [None] * self.num_layers,
+            "first_infer": 1,
+            "stage": 0,
+        }
+        xy_dec, _ = self.h(
+            (xy_pos, None), mask=self._expand_attn_mask(xy_attn_mask), cache=cache
+        )
+        return self.predict_logits(xy_dec[:, -1]), cache, padding_mask
+
+    def _decode_step_batch(self, cache, padding_mask, last_tokens, positions):
+        """
+        batch中每条样本各解码一步，cache原地更新。
+        last_tokens: (B, 1) 上一步生成的token；positions: (B,) 它们在各自audio序列中的位置。
+        返回 (logits, padding_mask)。
+        """
+        cache["first_infer"] = 0
+        xy_pos = self.ar_audio_position.forward_at(
+            self.ar_audio_embedding(last_tokens), positions
+        )
+        padding_mask = F.pad(padding_mask, (0, 1), value=False)
+        xy_dec, _ = self.h(
+            (xy_pos, None),
+            mask=self._expand_attn_mask(padding_mask.unsqueeze(1)),
+            cache=cache,
+        )
+        return self.predict_logits(xy_dec[:, -1]), padding_mask
+
+    def prefill_items(self, x_list, prompts_list, bert_list):
+        """
+        新加入解码的样本做首次前向。
+        返回 (logits, state)，state = {"cache", "padding_mask"} 为这批样本的batch解码状态，
+        可以用 merge_rows 并入其他batch，用 decode_step_rows 继续解码。
+        """
+        logits, cache, padding_mask = self._prefill_batch(x_list, prompts_list, bert_list)
+        return logits, {"cache": cache, "padding_mask": padding_mask}
+
+    def merge_rows(self, state, other):
+        """把other的样本并入state（原地更新state）：两边kv cache左侧padding到同一长度后按batch拼接"""
+        len_a = state["padding_mask"].shape[1]
+        len_b = other["padding_mask"].shape[1]
+        max_len = max(len_a, len_b)
+        cache = state["cache"]
+        for key in ("k", "v"):
+            for stage in range(self.num_layers):
+                cache[key][stage] = torch.cat([
+                    F.pad(cache[key][stage], (0, 0, 0, 0, max_len - len_a, 0)),
+                    F.pad(other["cache"][key][stage], (0, 0, 0, 0, max_len - len_b, 0)),
+                ], dim=1)
+        state["padding_mask"] = torch.cat([
+            F.pad(state["padding_mask"], (max_len - len_a, 0), value=True),
+            F.pad(other["padding_mask"], (max_len - len_b, 0), value=True),
+        ], dim=0)
+
+    def select_rows(self, state, keep):
+        """只保留下标在keep中的样本（原地更新state），并去掉所有样本都是padding的左侧部分"""
+        keep_idx = torch.tensor(keep, device=state["padding_mask"].device)
+        padding_mask = state["padding_mask"][keep_idx]
+        lead = int(padding_mask.all(dim=0).int().cumprod(dim=0).sum())
+        cache = state["cache"]
+        for key in ("k", "v"):
+            for stage in range(self.num_layers):
+                cache[key][stage] = cache[key][stage][lead:, keep_idx]
+        state["padding_mask"] = padding_mask[:, lead:]
+
+    def decode_step_rows(self, state, last_tokens, positions, step_fn=None):
+        """
+        state中的所有样本各解码一步，kv cache原地增长，batch的排布只在 merge_rows/select_rows 时改变。
+        样本可以在任意时刻加入或离开，用于连续batch（continuous batching）。
+        step_fn: 代替 _decode_step_batch 的函数（例如torch.compile编译后的版本）。
+        返回logits。
+        """
+        step_fn = step_fn or self._decode_step_batch
+        logits, state["padding_mask"] = step_fn(state["cache"], state["padding_mask"], last_tokens, positions)
+        return logits
+
+    def sample_next_token(self, logits, y, first_step, top_k=-100, top_p=100, temperature=1.0, out=None):
+        """
+        单条样本采样下一个token。logits: (V,)，y: 已有的token (1D)。
+        out: 可选的预分配buffer，前 len(y) 个位置就是y；新token直接写进去，不用每步重新拼接。
+        返回 (拼接新token后的y, 是否预测到EOS)。
+        """
+        if first_step:###第一次跑不能EOS否则没有了
+            logits = logits[:-1]  ###刨除1024终止符号的概率
+        samples = sample(
+            logits, y, top_k=top_k, top_p=top_p, repetition_penalty=1.35, temperature=temperature
+        )[0]
+        eos = bool(torch.argmax(logits, dim=-1) == self.EOS or samples[0] == self.EOS)
+        if out is None:
+            return torch.concat([y, samples]), eos
+        length = y.shape[0]
+        out[length:length + 1] = samples
+        return out[:length + 1], eos
+
+    def finish_decoding(self, y, prefix_len, ref_free):
+        """取出生成的semantic token：去掉结尾的EOS；有参考时与infer_panel一致，丢弃第一个生成的token"""
+        pred = y[prefix_len:-1]
+        if not ref_free:
+            pred = pred[1:]
+        if pred.shape[0] == 0:
+            pred = torch.zeros(1, dtype=y.dtype, device=y.device)
+            logger.warning("bad zero prediction")
+        logger.debug("T2S Decoding EOS [%d -> %d]", prefix_len, y.shape[0])
+        return pred
+
+    def infer_panel_batch(
+        self,
+        x_list,  #####每条样本的文本token, (len,)
+        prompts_list,  ####每条样本的参考音频token, (len,)，无参考时为None
+        bert_list,  ####每条样本的bert特征, (1024, len)
+        top_k=-100,
+        top_p=100,
+        early_stop_num: int = -1,
+        temperature=1.0,
+    ):
+        """
+        多条样本一起自回归解码，每一步只跑一次GPT前向。
+        已经结束的样本会从batch和kv cache中移除。
+        top_k/top_p/temperature 可以是单个值，也可以是每条样本一个值的列表。
+        返回每条样本生成的semantic token (1D)，与 infer_panel 的结果经调用方切片后一致。
+        """
+        bsz = len(x_list)
+        top_k, top_p, temperature = (
+            list(v) if isinstance(v, (list, tuple)) else [v] * bsz
+            for v in (top_k, top_p, temperature)
+        )
+        device = x_list[0].device
+        y_list = [
+            prompts if prompts is not None else torch.zeros(0, dtype=torch.long, device=device)
+            for prompts in prompts_list
+        ]
+        prefix_lens = [y.shape[0] for y in y_list]
+
+        ###################  first step ##########################
+        logits, cache, padding_mask = self._prefill_batch(x_list, prompts_list, bert_list)
+        alive = list(range(bsz))  ###仍在解码的样本在原batch中的下标
+        results = [None] * bsz
+        for idx in tqdm(range(1500)):
+            keep = []
+            for b, i in enumerate(alive):
+                y_list[i], stop = self.sample_next_token(
+                    logits[b], y_list[i], idx == 0,
+                    top_k=top_k[i], top_p=top_p[i], temperature=temperature[i]
+                )
+                if early_stop_num != -1 and (y_list[i].shape[0] - prefix_lens[i]) > early_stop_num:
+                    logger.info("use early stop num: %d", early_stop_num)
+                    stop = True
+                if stop:
+                    results[i] = self.finish_decoding(y_list[i], prefix_lens[i], prompts_list[i] is None)
+                else:
+                    keep.append(b)
+            if len(keep) == 0:
+                break
+
+            ####################### update next step ###################################
+            if len(keep) < len(alive):
+                keep_idx = torch.tensor(keep, device=device)
+                for stage in range(self.num_layers):
+                    cache["k"][stage] = cache["k"][stage][:, keep_idx]
+                    cache["v"][stage] = cache["v"][stage][:, keep_idx]
+                padding_mask = padding_mask[keep_idx]
+                alive = [alive[b] for b in keep]
+
+            last_tokens = torch.stack([y_list[i][-1:] for i in alive])
+            positions = torch.tensor([y_list[i].shape[0] - 1 for i in alive], device=device)
+            logits, padding_mask = self._decode_step_batch(cache, padding_mask, last_tokens, positions)
+
+        for i in alive:
+            if results[i] is None:
+                results[i] = y_list[i][prefix_lens[i]:]
+        return results
@@ -79,3 +79,9 @@ class SinePositionalEmbedding(nn.Module):
         output = x.unsqueeze(-1) if x.ndim == 2 else x
         output = output * self.x_scale + self.alpha * self.pe[:, : x.size(1)]
         return self.dropout(output)
+
+    def forward_at(self, x: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+        """x: (B, 1, D) 单步输入；positions: (B,) 每条样本各自的位置，用于batch解码"""
+        self.extend_pe(x.new_zeros(1, int(positions.max()) + 1))
+        output = x * self.x_scale + self.alpha * self.pe[0, positions].unsqueeze(1)
+        return self.dropout(output)
@@ -1 +1 @@
-from .infer_tool import InferenceModule, TTSInference
\ No newline at end of file
+from .infer_tool import InferenceModule, TTSInference, MODULE_FRONTEND, MODULE_GPT, MODULE_SOVITS, MODULE_DONE, is_queued_segment
\ No newline at end of file
@@ -2,9 +2,16 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from typing import Optional, Union
+from typing import List, Optional, Union
 from abc import abstractmethod, ABC
 from time import time as ttime
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from functools import lru_cache
+import bisect
+import hashlib
+import logging
+import threading
 
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 import numpy as np
@@ -21,6 +28,89 @@ from utils.utils import SupportedLanguage, load_audio
 from utils.config import DictToAttrRecursive
 from utils.cut import CUT_DICT, SPLITS, get_first
 
+logger = logging.getLogger(__name__)
+
+# batch推理时按音素序列长度分桶的上界
+PHONEME_BUCKETS = [32, 64, 128, 256, 512]
+# 自动选择batch大小时，估计每条文本推理需要的显存，以及batch大小的上限
+BATCH_ITEM_MEMORY = 256 << 20
+MAX_AUTO_BATCH = 32
+
+# 模块级动态batch中，pool项当前所处的模块
+MODULE_FRONTEND = 0
+MODULE_GPT = 1
+MODULE_SOVITS = 2
+MODULE_DONE = 3
+
+# 流式合成时每生成多少个semantic token交给SoVITS合成一次，以及每块向前多带的token数（保持块与块之间衔接连贯）
+STREAM_CHUNK_TOKENS = 25
+STREAM_OVERLAP_TOKENS = 10
+# 按 (参考音频路径, sovits模型) 缓存的参考音频semantic和频谱个数
+REF_CACHE_SIZE = 64
+# 每句话最多解码的步数，与infer_panel一致
+MAX_DECODE_STEPS = 1500
+# pool中同时做GPT解码的句子数上限，其余句子留在前端模块排队
+MAX_DECODE_ROWS = 16
+
+# 推理精度 -> GPT transformer部分使用的数据类型（fp32时不做转换）
+PRECISION_DTYPES = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def get_precision() -> str:
+    """
+    GPT transformer的推理精度 fp32/fp16/bf16，由环境变量 TTS_PRECISION 指定。
+    未指定时用fp32（低精度的音质还没有经过MOS评测，需要时手动开启）；没有显卡时只能用fp32。
+    只影响GPT的transformer部分，bert、hubert和SoVITS的精度由is_half决定。
+    """
+    if not torch.cuda.is_available():
+        return "fp32"
+    precision = os.environ.get("TTS_PRECISION", "fp32")
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f"不支持的TTS_PRECISION: {precision}，可选 {list(PRECISION_DTYPES)}")
+    return precision
+
+
+# LangSegment的过滤语言是全局状态，前端在多个线程中运行时设置和分段要一起加锁
+LANG_SEGMENT_LOCK = threading.Lock()
+
+# 处理好（已转换精度）的模型权重缓存目录，GPT_SOVITS_WEIGHT_CACHE=1 时启用
+WEIGHT_CACHE_DIR = "pretrained_models/.cache"
+
+
+def _weight_cache_path(path: str, tag: str) -> Optional[str]:
+    if os.environ.get("GPT_SOVITS_WEIGHT_CACHE", "0") != "1":
+        return None
+    with open(path, "rb") as f:
+        key = hashlib.sha256(f.read(1 << 20)).hexdigest()[:16]
+    return os.path.join(WEIGHT_CACHE_DIR, f"{key}-{tag}.pt")
+
+
+def load_cached_weights(path: str, tag: str) -> Optional[dict]:
+    """
+    读取checkpoint处理好之后的缓存 {"config", "weight"}，没有缓存或没启用时返回None。
+    用mmap读取，权重不用先完整拷贝进内存。key为checkpoint前1MB的sha256，tag区分不同精度。
+    """
+    cache_path = _weight_cache_path(path, tag)
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    return torch.load(cache_path, map_location="cpu", mmap=True)
+
+
+def save_cached_weights(path: str, tag: str, model_dict: dict):
+    """保存处理好的权重，下次启动或切换模型时由load_cached_weights直接读取"""
+    cache_path = _weight_cache_path(path, tag)
+    if cache_path is None:
+        return
+    os.makedirs(WEIGHT_CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    torch.save(model_dict, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+
+def is_queued_segment(item: dict) -> bool:
+    """pool项是否是已经做完前端、排队等待GPT解码的句子（请求本身在前端模块时没有segment_index）"""
+    return item["module_indicator"] == MODULE_FRONTEND and "segment_index" in item
+
 
 def merge_short_text_in_array(texts, threshold):
     if (len(texts)) < 2:
@@ -46,8 +136,10 @@ class InferenceModule(ABC):
                  sovits_weights: str=None,
                  gpt_weights: str=None,
                  is_half: bool=False,
+                 precision: Optional[str]=None,
                  bert_path: str='pretrained_models/chinese-roberta-wwm-ext-large',
                  cnhubert_path: str='pretrained_models/chinese-hubert-base',
+                 model_cache_size: int=4,
                  **kwargs,
                  ) -> None:
         self.sovits_model_path = sovits_weights
@@ -56,13 +148,35 @@ class InferenceModule(ABC):
         self.gpt_model = None
         self.sovits_config = None
         self.gpt_config = None
+        # precision只决定GPT transformer的精度，文本前端（bert）和参考音频的hubert特征保持FP32；
+        # is_half（SoVITS、bert、hubert整体用fp16）需要显式指定，不跟随precision
+        self.precision = precision or get_precision()
+        self.gpt_dtype = PRECISION_DTYPES[self.precision]
         self.is_half = is_half
+        # 磁盘权重缓存按精度区分
+        self.weight_cache_tag = self.precision + ("-half" if is_half else "")
         self.hz = 50
+        # 最近用过的模型放在内存(CPU)里，路径 -> (config, model)，切换回来时只需拷贝到显存，不用重新从磁盘加载
+        self.model_cache_size = model_cache_size
+        self.sovits_cache = OrderedDict()
+        self.gpt_cache = OrderedDict()
+        # 同一个参考音频（比如预设角色）只做一次HuBERT和频谱提取，换sovits模型时清空
+        self.get_reference = lru_cache(maxsize=REF_CACHE_SIZE)(self._compute_reference)
+        # TTS_COMPILE=1 时编译GPT解码一步的前向，gpt_step为编译后的函数，换GPT模型时重新编译
+        self.compile_gpt = os.environ.get("TTS_COMPILE", "0") == "1"
+        self.gpt_step = None
+        # TTS_STREAM_CHUNKS=1 时GPT解码过程中每 STREAM_CHUNK_TOKENS 个token就交给SoVITS分块合成，
+        # 默认关闭（分块合成的音质还没有验证），整句解码完后再一次合成
+        self.stream_chunks = os.environ.get("TTS_STREAM_CHUNKS", "0") == "1"
+        # 连续batch解码时各音素长度桶的batch kv cache，桶 -> {"state", "items"}，换GPT模型时清空
+        self.decode_groups = {}
         
         if torch.cuda.is_available():
             self.device = "cuda"
         else:
             self.device = "cpu"
+        # SoVITS在单独的CUDA stream上合成，和默认stream上的GPT解码重叠执行
+        self.sovits_stream = torch.cuda.Stream() if self.device == "cuda" else None
         
         if self.sovits_model_path is not None:
             self.change_sovits_weights(sovits_weights)
@@ -80,36 +194,107 @@ class InferenceModule(ABC):
         self.ssl_model.to(self.device)
 
                 
+    def _offload_model(self, cache: OrderedDict, path: str, config, model):
+        """把当前模型移回CPU放进缓存，超过 model_cache_size 时丢弃最久没用的"""
+        if model is None or self.model_cache_size <= 0:
+            return
+        cache[path] = (config, model.to("cpu"))
+        cache.move_to_end(path)
+        while len(cache) > self.model_cache_size:
+            cache.popitem(last=False)
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+
     def change_sovits_weights(self, sovits_weights: str):
-        model_dict = torch.load(sovits_weights, map_location="cpu")
-        self.sovits_config = DictToAttrRecursive(model_dict["config"])
+        ###先在CPU上准备好新模型，加载失败时当前模型保持不变
+        if sovits_weights in self.sovits_cache:
+            config, model = self.sovits_cache.pop(sovits_weights)
+            from_cache = True
+        else:
+            config, model = self._load_sovits(sovits_weights)
+            from_cache = False
+        self.get_reference.cache_clear()
+        self._offload_model(self.sovits_cache, self.sovits_model_path, self.sovits_config, self.sovits_model)
+        self.sovits_config = config
+        self.sovits_model = model.to(self.device, non_blocking=from_cache)
+        self.sovits_model.eval()
+        self.sovits_model_path = sovits_weights
+        logger.info("Model changed to: %s%s", sovits_weights, " (cached)" if from_cache else "")
+
+    def _load_sovits(self, sovits_weights: str):
+        """从磁盘加载sovits模型，返回 (config, CPU上的模型)"""
+        cached = load_cached_weights(sovits_weights, self.weight_cache_tag)
+        model_dict = cached or torch.load(sovits_weights, map_location="cpu")
+        config = DictToAttrRecursive(model_dict["config"])
         # sovits_config.model.semantic_frame_rate = "25hz"
-        self.sovits_model = SynthesizerTrn(
-            self.sovits_config.data.filter_length // 2 + 1,
-            self.sovits_config.train.segment_size // self.sovits_config.data.hop_length,
-            n_speakers=self.sovits_config.data.n_speakers,
-            **self.sovits_config.model
+        model = SynthesizerTrn(
+            config.data.filter_length // 2 + 1,
+            config.train.segment_size // config.data.hop_length,
+            n_speakers=config.data.n_speakers,
+            **config.model
         )
         # # enc q在推理时不需要
         # if ("pretrained" not in sovits_path):
         #     del vq_model.enc_q
-        self.sovits_model.load_state_dict(model_dict["weight"], strict=False)
+        ###缓存的权重已经是处理好的精度，直接用mmap的tensor作为参数
+        model.load_state_dict(model_dict["weight"], strict=False, assign=cached is not None)
         if self.is_half == True:
-            self.sovits_model = self.sovits_model.half()
-        self.sovits_model = self.sovits_model.to(self.device)
-        self.sovits_model.eval()
-        print(f'Model changed to: {sovits_weights}')
+            model = model.half()
+        if cached is None:
+            save_cached_weights(sovits_weights, self.weight_cache_tag,
+                                {"config": model_dict["config"], "weight": model.state_dict()})
+        return config, model
         
     def change_gpt_weights(self, gpt_weights: str):
-        model_dict = torch.load(gpt_weights, map_location="cpu")
-        self.gpt_config = DictToAttrRecursive(model_dict["config"])
-        self.gpt_model = Text2SemanticLightningModule(self.gpt_config, "****", is_train=False)
-        self.gpt_model.load_state_dict(model_dict["weight"])
-        if self.is_half == True:
-            self.gpt_model = self.gpt_model.half()
-        self.gpt_model = self.gpt_model.to(self.device)
+        ###先在CPU上准备好新模型，加载失败时当前模型保持不变
+        if gpt_weights in self.gpt_cache:
+            config, model = self.gpt_cache.pop(gpt_weights)
+            from_cache = True
+        else:
+            config, model = self._load_gpt(gpt_weights)
+            from_cache = False
+        self._offload_model(self.gpt_cache, self.gpt_model_path, self.gpt_config, self.gpt_model)
+        self.gpt_config = config
+        self.gpt_model = model.to(self.device, non_blocking=from_cache)
         self.gpt_model.eval()
-        print(f'Model changed to: {gpt_weights}') 
+        self.gpt_model_path = gpt_weights
+        self.gpt_step = self._compile_gpt_step()
+        self.decode_groups = {}
+        logger.info("Model changed to: %s%s", gpt_weights, " (cached)" if from_cache else "")
+
+    def _load_gpt(self, gpt_weights: str):
+        """从磁盘加载GPT模型，返回 (config, CPU上的模型)"""
+        cached = load_cached_weights(gpt_weights, self.weight_cache_tag)
+        model_dict = cached or torch.load(gpt_weights, map_location="cpu")
+        config = DictToAttrRecursive(model_dict["config"])
+        model = Text2SemanticLightningModule(config, "****", is_train=False)
+        model.load_state_dict(model_dict["weight"], assign=cached is not None)
+        if self.gpt_dtype is not None:
+            ###只把transformer部分转成低精度，文本/音频embedding和预测层保持FP32；
+            ###推理时transformer在autocast下运行，预测层在autocast之外按FP32计算（predict_logits）
+            model.model.h.to(self.gpt_dtype)
+        elif self.is_half == True:
+            model = model.half()
+        if cached is None:
+            save_cached_weights(gpt_weights, self.weight_cache_tag,
+                                {"config": model_dict["config"], "weight": model.state_dict()})
+        return config, model
+
+    def _compile_gpt_step(self):
+        """
+        用torch.compile编译当前GPT模型解码一步的前向，之前模型编译的结果全部作废。
+        连续batch中kv cache的长度每一步都在变，所以按动态形状编译，不用CUDA Graph。
+        """
+        if not self.compile_gpt:
+            return None
+        torch._dynamo.reset()
+        return torch.compile(self.gpt_model.model._decode_step_batch, dynamic=True)
+
+    def gpt_autocast(self):
+        """GPT前向所在的autocast环境，fp32时不启用"""
+        if self.gpt_dtype is None:
+            return nullcontext()
+        return torch.autocast("cuda", dtype=self.gpt_dtype)
         
        
     @abstractmethod
@@ -141,8 +326,296 @@ class TTSInference(InferenceModule):
               top_p: float=0.7,
               temperature: float=0.7,
               ref_free: bool=False,
+              prepared_text: Optional[dict]=None,
               **kwargs
               ):
+        prepared = self.prepare_request(ref_wav_path, prompt_text, prompt_language,
+                                        text, text_language, how_to_cut, ref_free,
+                                        prepared_text=prepared_text)
+        zero_wav = self.get_zero_wav()
+        audio_opt = []
+        for phones2, all_phoneme_ids, bert_features in prepared["segments"]:
+            all_phoneme_ids = all_phoneme_ids.unsqueeze(0)
+            bert_features = bert_features.unsqueeze(0)
+            all_phoneme_len = torch.tensor([all_phoneme_ids.shape[-1]]).to(self.device)
+            prompt = None if prepared["prompt"] is None else prepared["prompt"].unsqueeze(0)
+
+            with torch.no_grad(), self.gpt_autocast():
+                # pred_semantic = t2s_model.model.infer(
+                pred_semantic, idx = self.gpt_model.model.infer_panel(
+                    all_phoneme_ids,
+                    all_phoneme_len,
+                    prompt,
+                    bert_features,
+                    # prompt_phone_len=ph_offset,
+                    top_k=top_k,
+                    top_p=top_p,
+                    temperature=temperature,
+                    early_stop_num=self.hz * self.gpt_config.data.max_sec,
+                )
+
+            # print(pred_semantic.shape,idx)
+            pred_semantic = pred_semantic[:, -idx:][0]
+            audio_opt.append(self.decode_semantic(pred_semantic, phones2, prepared["refer"]))
+            audio_opt.append(zero_wav)
+        yield self.sovits_config.data.sampling_rate, (np.concatenate(audio_opt, 0) * 32768).astype(
+            np.int16
+        )
+
+    def infer_batch(self, requests: List[dict]):
+        """
+        批量推理。requests中每一项是infer的参数字典，所有请求切句后的全部句子合成一个batch做GPT解码。
+        返回与requests一一对应的 (sampling_rate, audio) 列表。
+        """
+        prepared_list = []
+        x_list, prompts_list, bert_list = [], [], []
+        top_k, top_p, temperature = [], [], []
+        for request in requests:
+            prepared = self.prepare_request(request["ref_wav_path"],
+                                            request["prompt_text"],
+                                            request["prompt_language"],
+                                            request["text"],
+                                            request["text_language"],
+                                            request["how_to_cut"],
+                                            request.get("ref_free", False),
+                                            prepared_text=request.get("prepared_text"))
+            prepared_list.append(prepared)
+            for _, all_phoneme_ids, bert_features in prepared["segments"]:
+                x_list.append(all_phoneme_ids)
+                prompts_list.append(prepared["prompt"])
+                bert_list.append(bert_features)
+                top_k.append(request.get("top_k", 5))
+                top_p.append(request.get("top_p", 0.7))
+                temperature.append(request.get("temperature", 0.7))
+
+        # 按音素长度分桶，每个桶单独做一次batch解码，padding只补到桶内最长的句子
+        buckets = {}
+        for i, x in enumerate(x_list):
+            buckets.setdefault(bisect.bisect_left(PHONEME_BUCKETS, x.shape[0]), []).append(i)
+        pred_semantics = [None] * len(x_list)
+        for indices in buckets.values():
+            with torch.no_grad(), self.gpt_autocast():
+                preds = self.gpt_model.model.infer_panel_batch(
+                    [x_list[i] for i in indices],
+                    [prompts_list[i] for i in indices],
+                    [bert_list[i] for i in indices],
+                    top_k=[top_k[i] for i in indices],
+                    top_p=[top_p[i] for i in indices],
+                    temperature=[temperature[i] for i in indices],
+                    early_stop_num=self.hz * self.gpt_config.data.max_sec,
+                )
+            for i, pred in zip(indices, preds):
+                pred_semantics[i] = pred
+
+        zero_wav = self.get_zero_wav()
+        results = []
+        pred_iter = iter(pred_semantics)
+        for prepared in prepared_list:
+            audio_opt = []
+            for phones2, _, _ in prepared["segments"]:
+                audio_opt.append(self.decode_semantic(next(pred_iter), phones2, prepared["refer"]))
+                audio_opt.append(zero_wav)
+            if not audio_opt:
+                audio_opt.append(zero_wav)
+            results.append((self.sovits_config.data.sampling_rate,
+                            (np.concatenate(audio_opt, 0) * 32768).astype(np.int16)))
+        return results
+
+    def auto_batch_size(self) -> int:
+        """按当前空闲显存估计infer_batch一次能合成多少条文本"""
+        if self.device != "cuda":
+            return 1
+        free, _ = torch.cuda.mem_get_info()
+        return int(max(1, min(MAX_AUTO_BATCH, free // BATCH_ITEM_MEMORY)))
+
+    def run_frontend(self, request: dict):
+        """
+        前端模块。request为infer的参数字典，按切句展开成若干个pool项，
+        每一项是一句话的GPT解码状态，request本身保存在项的"request"字段中。
+        句子项先停在前端模块（module_indicator 0）排队，由 gpt_decode_step 在有空位时转入GPT解码。
+        """
+        prepared = self.prepare_request(request["ref_wav_path"],
+                                        request["prompt_text"],
+                                        request["prompt_language"],
+                                        request["text"],
+                                        request["text_language"],
+                                        request["how_to_cut"],
+                                        request.get("ref_free", False),
+                                        prepared_text=request.get("prepared_text"))
+        prompt = prepared["prompt"]
+        prefix_len = 0 if prompt is None else prompt.shape[0]
+        items = []
+        for index, (phones2, all_phoneme_ids, bert_features) in enumerate(prepared["segments"]):
+            items.append({
+                "module_indicator": MODULE_FRONTEND,
+                "request": request,
+                "segment_index": index,
+                "phones": torch.LongTensor(phones2).to(self.device),
+                "x": all_phoneme_ids,
+                "bert": bert_features,
+                "prompt": prompt,
+                "refer": prepared["refer"],
+                "semantic_buf": None,
+                "y": None,
+                "prefix_len": prefix_len,
+                "step": 0,
+                ###生成的semantic从y的这个位置开始算（有参考时与infer_panel一致，丢弃第一个生成的token）
+                "pred_start": 0 if prompt is None else prompt.shape[0] + 1,
+                "emitted": 0,
+                "gain": 1.0,
+                "chunks": deque(),
+                "audio_chunks": deque(),
+                "top_k": request.get("top_k", 5),
+                "top_p": request.get("top_p", 0.7),
+                "temperature": request.get("temperature", 0.7),
+            })
+        return items
+
+    def gpt_decode_step(self, pool: List[dict]):
+        """
+        GPT模块（module_indicator 1）：pool中所有正在解码的句子一起前进一个token。
+        正在解码的句子按音素长度分桶，每个桶保存一份batch的kv cache（self.decode_groups），
+        新加入的句子做首次前向后并入对应的桶，离开的句子在下一步开始时从桶里去掉，
+        kv cache的排布只在桶的成员变化时调整；解码结束的句子转入SoVITS模块（module_indicator 2）。
+        """
+        model = self.gpt_model.model
+        items = [item for item in pool if item["module_indicator"] == MODULE_GPT]
+        ###排队中的句子按顺序补进空位，同时解码的句子不超过 MAX_DECODE_ROWS
+        queued = [item for item in pool if is_queued_segment(item)]
+        for item in queued[:max(MAX_DECODE_ROWS - len(items), 0)]:
+            self.start_decoding(item)
+            items.append(item)
+        decoding = {id(item) for item in items}
+        stepped = []
+        with torch.no_grad(), self.gpt_autocast():
+            for bucket, group in list(self.decode_groups.items()):
+                ###已经解码结束或被移出pool（请求出错）的句子从batch中去掉
+                keep = [b for b, item in enumerate(group["items"]) if id(item) in decoding]
+                if not keep:
+                    del self.decode_groups[bucket]
+                    continue
+                if len(keep) < len(group["items"]):
+                    model.select_rows(group["state"], keep)
+                    group["items"] = [group["items"][b] for b in keep]
+                last_tokens = torch.stack([item["y"][-1:] for item in group["items"]])
+                positions = torch.tensor([item["y"].shape[0] - 1 for item in group["items"]], device=self.device)
+                logits = model.decode_step_rows(group["state"], last_tokens, positions, step_fn=self.gpt_step)
+                stepped.extend(zip(group["items"], logits))
+
+            buckets = {}
+            for item in items:
+                if item["step"] == 0:
+                    buckets.setdefault(bisect.bisect_left(PHONEME_BUCKETS, item["x"].shape[0]), []).append(item)
+            for bucket, new_items in buckets.items():
+                logits, state = model.prefill_items([item["x"] for item in new_items],
+                                                    [item["prompt"] for item in new_items],
+                                                    [item["bert"] for item in new_items])
+                stepped.extend(zip(new_items, logits))
+                group = self.decode_groups.get(bucket)
+                if group is None:
+                    self.decode_groups[bucket] = {"state": state, "items": new_items}
+                else:
+                    model.merge_rows(group["state"], state)
+                    group["items"].extend(new_items)
+
+            early_stop_num = self.hz * self.gpt_config.data.max_sec
+            for item, logits in stepped:
+                item["y"], stop = model.sample_next_token(logits, item["y"], item["step"] == 0,
+                                                          top_k=item["top_k"],
+                                                          top_p=item["top_p"],
+                                                          temperature=item["temperature"],
+                                                          out=item["semantic_buf"])
+                item["step"] += 1
+                if item["y"].shape[0] - item["prefix_len"] > early_stop_num:
+                    logger.info("use early stop num: %d", early_stop_num)
+                    stop = True
+                if item["step"] >= MAX_DECODE_STEPS:
+                    stop = True
+                if stop:
+                    item["pred_semantic"] = model.finish_decoding(item["y"], item["prefix_len"], item["prompt"] is None)
+                    self.push_semantic_chunk(item, item["pred_semantic"])
+                    item["module_indicator"] = MODULE_SOVITS
+                elif self.stream_chunks:
+                    ###最新的token可能是最后被丢弃的那个，先不交给SoVITS
+                    available = item["y"][item["pred_start"]:-1]
+                    if available.shape[0] - item["emitted"] >= STREAM_CHUNK_TOKENS:
+                        self.push_semantic_chunk(item, available)
+
+    def start_decoding(self, item: dict):
+        """句子项转入GPT解码，module_indicator 0 -> 1"""
+        prompt, prefix_len = item["prompt"], item["prefix_len"]
+        ###semantic token预分配在显存上，GPT逐个写入，交给SoVITS的块都是它的视图，不经过拷贝
+        semantic_buf = torch.empty(prefix_len + MAX_DECODE_STEPS + 1,
+                                   dtype=torch.long if prompt is None else prompt.dtype,
+                                   device=self.device)
+        if prompt is not None:
+            semantic_buf[:prefix_len] = prompt
+        item["semantic_buf"] = semantic_buf
+        item["y"] = semantic_buf[:prefix_len]
+        item["module_indicator"] = MODULE_GPT
+
+    def push_semantic_chunk(self, item: dict, semantic):
+        """
+        把一句话到目前为止的semantic token中还没合成的部分交给SoVITS，向前多带 STREAM_OVERLAP_TOKENS 个已合成的token。
+        在默认stream上记录event，SoVITS所在的stream等到这个event之后再读取这些token。
+        """
+        end = semantic.shape[0]
+        if end <= item["emitted"]:
+            return
+        start = max(item["emitted"] - STREAM_OVERLAP_TOKENS, 0)
+        event = None
+        if self.sovits_stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+        item["chunks"].append((semantic[start:end], item["emitted"] - start, event))
+        item["emitted"] = end
+
+    def sovits_decode(self, pool: List[dict]):
+        """
+        SoVITS模块：合成pool中各句话已经交过来的semantic块，音频按顺序放进项的"audio_chunks"，
+        整句合成完后补上句间静音，module_indicator 2 -> 3。
+        在 sovits_stream 上运行，可以和GPT解码（gpt_decode_step）在不同线程中同时调用。
+        """
+        sr = self.sovits_config.data.sampling_rate
+        samples_per_token = self.sovits_config.data.hop_length * (2 if self.sovits_model.semantic_frame_rate == "25hz" else 1)
+        stream_ctx = torch.cuda.stream(self.sovits_stream) if self.sovits_stream is not None else nullcontext()
+        with stream_ctx:
+            for item in pool:
+                ###先看状态再取块：GPT在标记完成之前已经放入了最后一块
+                finished = item["module_indicator"] == MODULE_SOVITS
+                if not finished and item["module_indicator"] != MODULE_GPT:
+                    continue
+                while item["chunks"]:
+                    semantic, overlap, event = item["chunks"].popleft()
+                    if event is not None:
+                        self.sovits_stream.wait_event(event)
+                        semantic.record_stream(self.sovits_stream)
+                    audio = self.decode_semantic(semantic, item["phones"], item["refer"], normalize=False)
+                    audio = audio[overlap * samples_per_token:]
+                    ###整句共用一个增益防止16bit爆音：峰值超过1时增益只降不升，不按块单独归一化，避免块间音量跳变
+                    peak = np.abs(audio).max(initial=0)
+                    if peak * item["gain"] > 1:
+                        item["gain"] = 1 / peak
+                    audio = np.clip(audio * item["gain"], -1, 1)
+                    item["sr"] = sr
+                    item["audio_chunks"].append((audio * 32768).astype(np.int16))
+                if finished:
+                    item["sr"] = sr
+                    item["audio_chunks"].append((self.get_zero_wav() * 32768).astype(np.int16))
+                    item["module_indicator"] = MODULE_DONE
+
+    def prepare_text(self,
+                     prompt_text: Optional[str],
+                     prompt_language: SupportedLanguage,
+                     text: str,
+                     text_language: SupportedLanguage,
+                     how_to_cut: str,
+                     ref_free: bool=False):
+        """
+        前端的纯CPU部分：参考文本和目标文本规整、切句并转成音素，不使用GPU，可以在线程池中和GPU解码同时运行。
+        返回 {"ref_free": 是否无参考, "prompt_parts": 参考文本的音素片段或None, "text_parts": [每句的音素片段]}，
+        交给 prepare_request 完成bert特征等GPU部分。
+        """
         if prompt_text is None or len(prompt_text) == 0:
             ref_free = True
             
@@ -157,35 +630,6 @@ class TTSInference(InferenceModule):
             text = "。" + text if text_language!= "en" else "." + text
         print("实际输入的目标文本:", text)
         
-        zero_wav = np.zeros(
-            int(self.sovits_config.data.sampling_rate * 0.3),
-            dtype=np.float32
-        )
-        
-        with torch.no_grad():
-            if isinstance(ref_wav_path, str):
-                wav16k, _ = librosa.load(ref_wav_path, sr=16000)
-            else:
-                wav16k, _ = ref_wav_path
-            if (wav16k.shape[0] > 160000 or wav16k.shape[0] < 16000):
-                raise OSError("参考音频在3~10秒范围外，请更换！")
-            wav16k = torch.from_numpy(wav16k)
-            zero_wav_torch = torch.from_numpy(zero_wav)
-            if self.is_half == True:
-                wav16k = wav16k.half().to(self.device)
-                zero_wav_torch = zero_wav_torch.half().to(self.device)
-            else:
-                wav16k = wav16k.to(self.device)
-                zero_wav_torch = zero_wav_torch.to(self.device)
-            wav16k = torch.cat([wav16k, zero_wav_torch])
-            ssl_content = self.ssl_model.model(wav16k.unsqueeze(0))[
-                "last_hidden_state"
-            ].transpose(
-                1, 2
-            )  # .float()
-            codes = self.sovits_model.extract_latent(ssl_content)
-            prompt_semantic = codes[0, 0]
-        
         cut_func = CUT_DICT.get(how_to_cut, None)
         if cut_func:
             text = cut_func(text)
@@ -195,10 +639,7 @@ class TTSInference(InferenceModule):
         
         texts = text.split("\n")
         texts = merge_short_text_in_array(texts, 5)
-        audio_opt = []
-        if not ref_free:
-            phones1, bert_features1, norm_text1 = self.get_phones_and_bert(prompt_text, prompt_language)
-            
+        text_parts = []
         for text in texts:
             # 解决输入目标文本的空行导致报错的问题
             if (len(text.strip()) == 0):
@@ -206,55 +647,117 @@ class TTSInference(InferenceModule):
             if (text[-1] not in SPLITS): 
                 text += "。" if text_language != "en" else "."
             print("实际输入的目标文本(每句):", text)
+            text_parts.append(self.get_phones(text, text_language))
+        return {
+            "ref_free": ref_free,
+            "prompt_parts": None if ref_free else self.get_phones(prompt_text, prompt_language),
+            "text_parts": text_parts,
+        }
+
+    def prepare_request(self,
+                        ref_wav_path: Union[str, np.ndarray],
+                        prompt_text: Optional[str],
+                        prompt_language: SupportedLanguage,
+                        text: str,
+                        text_language: SupportedLanguage,
+                        how_to_cut: str,
+                        ref_free: bool=False,
+                        prepared_text: Optional[dict]=None):
+        """
+        单个请求的前端处理：参考音频提取semantic和频谱，目标文本切句并转成音素和bert特征。
+        prepared_text为已经算好的 prepare_text 结果，为None时在这里计算。
+        返回 {"prompt": 参考semantic或None, "refer": 参考频谱, "segments": [(phones2, all_phoneme_ids, bert_features)]}
+        """
+        if prepared_text is None:
+            prepared_text = self.prepare_text(prompt_text, prompt_language, text, text_language, how_to_cut, ref_free)
+        ref_free = prepared_text["ref_free"]
+        
+        if isinstance(ref_wav_path, str):
+            prompt_semantic, refer = self.get_reference(ref_wav_path, self.sovits_model_path)
+        else:
+            prompt_semantic, refer = self._compute_reference(ref_wav_path, self.sovits_model_path)
+        
+        if not ref_free:
+            phones1, bert_features1, norm_text1 = self.get_bert_from_phones(prepared_text["prompt_parts"])
             
-            phones2, bert_features2, norm_text2 = self.get_phones_and_bert(text, text_language)
+        segments = []
+        for parts in prepared_text["text_parts"]:
+            phones2, bert_features2, norm_text2 = self.get_bert_from_phones(parts)
             print("前端处理后的文本(每句):", norm_text2)
             
             if not ref_free:
                 bert_features = torch.cat([bert_features1, bert_features2], 1)
-                all_phoneme_ids = torch.LongTensor(phones1+phones2).to(self.device).unsqueeze(0)
+                all_phoneme_ids = torch.LongTensor(phones1+phones2).to(self.device)
             else:
                 bert_features = bert_features2
-                all_phoneme_ids = torch.LongTensor(phones2).to(self.device).unsqueeze(0)
+                all_phoneme_ids = torch.LongTensor(phones2).to(self.device)
+            segments.append((phones2, all_phoneme_ids, bert_features.to(self.device)))
 
-            bert_features = bert_features.to(self.device).unsqueeze(0)
-            all_phoneme_len = torch.tensor([all_phoneme_ids.shape[-1]]).to(self.device)
-            prompt = prompt_semantic.unsqueeze(0).to(self.device)
+        return {
+            "prompt": None if ref_free else prompt_semantic,
+            "refer": refer,
+            "segments": segments,
+        }
 
-            with torch.no_grad():
-                # pred_semantic = t2s_model.model.infer(
-                pred_semantic, idx = self.gpt_model.model.infer_panel(
-                    all_phoneme_ids,
-                    all_phoneme_len,
-                    None if ref_free else prompt,
-                    bert_features,
-                    # prompt_phone_len=ph_offset,
-                    top_k=top_k,
-                    top_p=top_p,
-                    temperature=temperature,
-                    early_stop_num=self.hz * self.gpt_config.data.max_sec,
-                )
-
-            # print(pred_semantic.shape,idx)
-            pred_semantic = pred_semantic[:, -idx:].unsqueeze(
-                0
-            )  # .unsqueeze(0)#mq要多unsqueeze一次
-            refer = self.get_spepc(ref_wav_path)  # .to(device)
+    def _compute_reference(self, ref_wav_path: Union[str, np.ndarray], sovits_weights: str):
+        """
+        参考音频经HuBERT和sovits得到的semantic token，以及参考频谱，都放在显存上。
+        sovits_weights只用作缓存的key（get_reference），结果与当时的sovits模型对应。
+        """
+        zero_wav = self.get_zero_wav()
+        
+        with torch.no_grad():
+            if isinstance(ref_wav_path, str):
+                wav16k, _ = librosa.load(ref_wav_path, sr=16000)
+            else:
+                wav16k, _ = ref_wav_path
+            if (wav16k.shape[0] > 160000 or wav16k.shape[0] < 16000):
+                raise OSError("参考音频在3~10秒范围外，请更换！")
+            wav16k = torch.from_numpy(wav16k)
+            zero_wav_torch = torch.from_numpy(zero_wav)
             if self.is_half == True:
-                refer = refer.half()
-            refer = refer.to(self.device)
+                wav16k = wav16k.half().to(self.device)
+                zero_wav_torch = zero_wav_torch.half().to(self.device)
+            else:
+                wav16k = wav16k.to(self.device)
+                zero_wav_torch = zero_wav_torch.to(self.device)
+            wav16k = torch.cat([wav16k, zero_wav_torch])
+            ssl_content = self.ssl_model.model(wav16k.unsqueeze(0))[
+                "last_hidden_state"
+            ].transpose(
+                1, 2
+            )  # .float()
+            codes = self.sovits_model.extract_latent(ssl_content)
+            prompt_semantic = codes[0, 0]
+
+        refer = self.get_spepc(ref_wav_path)  # .to(device)
+        if self.is_half == True:
+            refer = refer.half()
+        return prompt_semantic.to(self.device), refer.to(self.device)
+
+    def decode_semantic(self, pred_semantic, phones2, refer, normalize: bool=True):
+        """
+        把一句话的semantic token (1D) 用sovits解码成音频，phones2可以是列表或已在显存上的tensor。
+        normalize=False 时不做峰值归一化，由调用方处理（分块合成时整句共用一个增益）。
+        """
+        pred_semantic = pred_semantic.unsqueeze(0).unsqueeze(0)  # .unsqueeze(0)#mq要多unsqueeze一次
+        if not torch.is_tensor(phones2):
+            phones2 = torch.LongTensor(phones2).to(self.device)
+        with torch.no_grad():
             # audio = vq_model.decode(pred_semantic, all_phoneme_ids, refer).detach().cpu().numpy()[0, 0]
-            audio = (
-                self.sovits_model.decode(
-                    pred_semantic, torch.LongTensor(phones2).to(self.device).unsqueeze(0), refer
-                ).detach().cpu().numpy()[0, 0]
-            )  ###试试重建不带上prompt部分
-            max_audio=np.abs(audio).max()#简单防止16bit爆音
-            if max_audio>1:audio/=max_audio
-            audio_opt.append(audio)
-            audio_opt.append(zero_wav)
-        yield self.sovits_config.data.sampling_rate, (np.concatenate(audio_opt, 0) * 32768).astype(
-            np.int16
+            audio = self.sovits_model.decode(
+                pred_semantic, phones2.unsqueeze(0), refer
+            )[0, 0]  ###试试重建不带上prompt部分
+            ###简单防止16bit爆音，在显存上做完再一次性拷回内存
+            if normalize:
+                audio = audio / audio.abs().max().clamp(min=1)
+        return audio.float().cpu().numpy()
+
+    def get_zero_wav(self):
+        """句间插入的0.3秒静音"""
+        return np.zeros(
+            int(self.sovits_config.data.sampling_rate * 0.3),
+            dtype=np.float32
         )
 
             
@@ -281,31 +784,35 @@ class TTSInference(InferenceModule):
 
 
     def get_phones_and_bert(self, text, language):
-        dtype=torch.float16 if self.is_half == True else torch.float32
+        return self.get_bert_from_phones(self.get_phones(text, language))
+
+
+    def get_phones(self, text, language):
+        """
+        文本按语言分段并转成音素（纯CPU），返回 [(phones, word2ph, norm_text, language)]，
+        由 get_bert_from_phones 计算bert特征。
+        """
         if language in {"en","all_zh","all_ja"}:
             language = language.replace("all_","")
             if language == "en":
-                LangSegment.setfilters(["en"])
-                formattext = " ".join(tmp["text"] for tmp in LangSegment.getTexts(text))
+                with LANG_SEGMENT_LOCK:
+                    LangSegment.setfilters(["en"])
+                    formattext = " ".join(tmp["text"] for tmp in LangSegment.getTexts(text))
             else:
                 # 因无法区别中日文汉字,以用户输入为准
                 formattext = text
             while "  " in formattext:
                 formattext = formattext.replace("  ", " ")
             phones, word2ph, norm_text = self.clean_text_inf(formattext, language)
-            if language == "zh":
-                bert_features = self.get_bert_feature(norm_text, word2ph).to(self.device)
-            else:
-                bert_features = torch.zeros(
-                    (1024, len(phones)),
-                    dtype=torch.float16 if self.is_half == True else torch.float32,
-                ).to(self.device)
+            return [(phones, word2ph, norm_text, language)]
         elif language in {"zh", "ja","auto"}:
             textlist=[]
             langlist=[]
-            LangSegment.setfilters(["zh","ja","en", "ko"])
+            with LANG_SEGMENT_LOCK:
+                LangSegment.setfilters(["zh","ja","en", "ko"])
+                segments = LangSegment.getTexts(text)
             if language == "auto":
-                for tmp in LangSegment.getTexts(text):
+                for tmp in segments:
                     if tmp["lang"] == "ko":
                         langlist.append("zh")
                         textlist.append(tmp["text"])
@@ -313,7 +820,7 @@ class TTSInference(InferenceModule):
                         langlist.append(tmp["lang"])
                         textlist.append(tmp["text"])
             else:
-                for tmp in LangSegment.getTexts(text):
+                for tmp in segments:
                     if tmp["lang"] == "en":
                         langlist.append(tmp["lang"])
                     else:
@@ -322,20 +829,21 @@ class TTSInference(InferenceModule):
                     textlist.append(tmp["text"])
             print(textlist)
             print(langlist)
-            phones_list = []
-            bert_list = []
-            norm_text_list = []
+            parts = []
             for i in range(len(textlist)):
                 lang = langlist[i]
                 phones, word2ph, norm_text = self.clean_text_inf(textlist[i], lang)
-                bert_feature = self.get_bert_inf(phones, word2ph, norm_text, lang)
-                phones_list.append(phones)
-                norm_text_list.append(norm_text)
-                bert_list.append(bert_feature)
-            bert_features = torch.cat(bert_list, dim=1)
-            phones = sum(phones_list, [])
-            norm_text = ''.join(norm_text_list)
+                parts.append((phones, word2ph, norm_text, lang))
+            return parts
 
+
+    def get_bert_from_phones(self, parts):
+        """get_phones 的结果计算bert特征并拼接，返回 (phones, bert_features, norm_text)"""
+        dtype=torch.float16 if self.is_half == True else torch.float32
+        bert_features = torch.cat([self.get_bert_inf(phones, word2ph, norm_text, lang)
+                                   for phones, word2ph, norm_text, lang in parts], dim=1)
+        phones = sum([phones for phones, _, _, _ in parts], [])
+        norm_text = ''.join(norm_text for _, _, norm_text, _ in parts)
         return phones, bert_features.to(dtype), norm_text
 
 